@@ -14,6 +14,14 @@ class Settings(BaseSettings):
     IMAP_FOLDER: str = "INBOX"
     IMAP_POLL_INTERVAL: int = 30
 
+    # Email parsing
+    EMAIL_MAX_RAW_BYTES: int = 10 * 1024 * 1024
+    EMAIL_MAX_BODY_CHARS: int = 10000
+    EMAIL_MAX_MIME_DEPTH: int = 10
+    EMAIL_MAX_MIME_PARTS: int = 200
+    EMAIL_PARSE_WORKERS: int = 0
+    EMAIL_PARSE_POOL_MIN_BATCH: int = 20
+
     # ML Service
     ML_SERVICE_URL: str = "http://localhost:8000/api/v1/ml/analyze"
 
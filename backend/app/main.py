@@ -16,6 +16,7 @@ from app.database import engine, Base
 from app.routes.emails import router as emails_router
 from app.routes.ml import router as ml_router
 from app.services.email_ingestion import poll_mailbox
+from app.services.email_parser import shutdown_pool
 
 logging.basicConfig(
     level=logging.INFO,
@@ -50,6 +51,7 @@ async def lifespan(app: FastAPI):
 
     # Shutdown
     scheduler.shutdown(wait=False)
+    shutdown_pool()
     logger.info("Scheduler stopped.")
 
 
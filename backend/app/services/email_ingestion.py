@@ -7,10 +7,6 @@ and triggers the ML processing pipeline.
 """
 
 import logging
-import email as email_lib
-from email.header import decode_header
-from email.utils import parseaddr
-from typing import Optional
 
 from imapclient import IMAPClient
 from sqlalchemy.orm import Session
@@ -18,53 +14,13 @@ from sqlalchemy.orm import Session
 from app.config import get_settings
 from app.database import SessionLocal
 from app.models import Email
+from app.services.email_parser import parse_many
 from app.services.pipeline import process_email
 
 logger = logging.getLogger(__name__)
 settings = get_settings()
 
 
-def decode_mime_header(header_value: str) -> str:
-    """Decode a MIME-encoded email header."""
-    if not header_value:
-        return ""
-    decoded_parts = decode_header(header_value)
-    result = []
-    for part, charset in decoded_parts:
-        if isinstance(part, bytes):
-            result.append(part.decode(charset or "utf-8", errors="replace"))
-        else:
-            result.append(part)
-    return " ".join(result)
-
-
-def extract_body(msg: email_lib.message.Message) -> str:
-    """Extract plain text body from an email message."""
-    if msg.is_multipart():
-        for part in msg.walk():
-            content_type = part.get_content_type()
-            content_disposition = str(part.get("Content-Disposition", ""))
-            if content_type == "text/plain" and "attachment" not in content_disposition:
-                payload = part.get_payload(decode=True)
-                if payload:
-                    charset = part.get_content_charset() or "utf-8"
-                    return payload.decode(charset, errors="replace")
-        # Fallback: try to get HTML
-        for part in msg.walk():
-            content_type = part.get_content_type()
-            if content_type == "text/html":
-                payload = part.get_payload(decode=True)
-                if payload:
-                    charset = part.get_content_charset() or "utf-8"
-                    return payload.decode(charset, errors="replace")
-    else:
-        payload = msg.get_payload(decode=True)
-        if payload:
-            charset = msg.get_content_charset() or "utf-8"
-            return payload.decode(charset, errors="replace")
-    return ""
-
-
 def poll_mailbox():
     """
     Connect to IMAP server, fetch unseen emails, store and process them.
@@ -90,15 +46,18 @@ def poll_mailbox():
             # Fetch messages
             fetched = client.fetch(messages, ["RFC822", "ENVELOPE"])
 
+            # Parse off the DB session; spreads across processes for large batches
+            uids = list(fetched.keys())
+            parsed_emails = parse_many(fetched[uid][b"RFC822"] for uid in uids)
+
             db: Session = SessionLocal()
             try:
-                for uid, data in fetched.items():
+                for uid, parsed in zip(uids, parsed_emails):
+                    if parsed is None:
+                        logger.error(f"Failed to parse message UID {uid}, skipping")
+                        continue
                     try:
-                        raw_email = data[b"RFC822"]
-                        msg = email_lib.message_from_bytes(raw_email)
-
-                        # Extract message ID for deduplication
-                        message_id = msg.get("Message-ID", "")
+                        message_id = parsed.message_id
 
                         # Check if already exists
                         existing = db.query(Email).filter(
@@ -108,17 +67,14 @@ def poll_mailbox():
                             logger.debug(f"Skipping duplicate: {message_id}")
                             continue
 
-                        # Parse fields
-                        sender_name, sender_addr = parseaddr(msg.get("From", ""))
-                        sender = sender_addr or decode_mime_header(msg.get("From", "unknown"))
-                        subject = decode_mime_header(msg.get("Subject", "(no subject)"))
-                        body = extract_body(msg)
+                        sender = parsed.sender
+                        subject = parsed.subject
 
                         # Store in database with status NEW
                         email_record = Email(
                             sender=sender,
                             subject=subject,
-                            body=body[:10000],  # Limit body size
+                            body=parsed.body,  # Already capped at EMAIL_MAX_BODY_CHARS
                             status="NEW",
                             message_id=message_id,
                         )
@@ -0,0 +1,545 @@
+"""
+Email parsing service.
+
+Turns raw RFC822 bytes into normalized plain text ready for ML analysis:
+bounded MIME traversal, charset fallback, streaming HTML-to-text,
+and quoted-reply / signature stripping.
+
+Parsing is CPU-bound and pure, so large backlogs can be spread across
+a process pool instead of blocking the ingestion thread on the GIL.
+"""
+
+import logging
+import multiprocessing
+import re
+import email as email_lib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from email.header import decode_header
+from email.message import Message
+from email.parser import BytesHeaderParser
+from email.utils import parseaddr
+from html.parser import HTMLParser
+from typing import Iterable, List, Optional
+
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+# Single-byte Cyrillic codecs tried when a payload is not valid UTF-8.
+# Almost any byte sequence decodes under both, so the winner is picked
+# by _cyrillic_score rather than by which one raises no error.
+CYRILLIC_CHARSETS = ["cp1251", "koi8-r"]
+
+# Most frequent Russian letters, used to tell a correct decode from a garbled one
+COMMON_CYRILLIC = set("оеаинтсрвлкмдпу")
+
+# Minimum _cyrillic_score for a decode to count as plausible
+MIN_CYRILLIC_SCORE = 1.0
+
+# Share of U+FFFD in a lenient UTF-8 decode above which an undeclared
+# payload is treated as some other charset rather than UTF-8 with a few bad bytes
+MAX_UTF8_ERROR_RATE = 0.05
+
+# Max number of sender domains kept in the charset cache
+CHARSET_CACHE_SIZE = 1024
+
+# Size of chunks fed to the HTML parser
+HTML_CHUNK_SIZE = 16384
+
+# Hard cap on HTML characters fed to the parser, after data: URIs are removed
+HTML_MAX_INPUT_CHARS = 2_000_000
+
+# HTMLParser rescans its unconsumed buffer on every feed(), so an unclosed
+# tag makes parsing quadratic. Stop once that buffer grows past this.
+HTML_MAX_PENDING_CHARS = 262144
+
+# Inline base64 payloads (data: URIs), removed before parsing
+DATA_URI_PATTERN = re.compile(r"data:[\w/+.-]*;base64,[A-Za-z0-9+/=]*", re.IGNORECASE)
+
+# HTML elements whose content is never visible text. <head> is not listed:
+# many emails never close it, which would swallow the whole body.
+SKIP_TAGS = {"script", "style", "title", "noscript", "template", "svg"}
+
+# HTML elements that start a new line in rendered text
+BLOCK_TAGS = {
+    "p", "div", "br", "tr", "li", "ul", "ol", "table", "blockquote",
+    "h1", "h2", "h3", "h4", "h5", "h6", "hr", "section", "article",
+}
+
+# HTML table cells, separated by a space so adjacent cells don't merge
+CELL_TAGS = {"td", "th"}
+
+# Lines that introduce a quoted previous message; everything after is dropped
+REPLY_HEADER_PATTERNS = [
+    re.compile(r"^\s*On .{0,200} wrote:\s*$", re.IGNORECASE),
+    # "15.03.2024, 10:20, Иван <ivan@x.ru> пишет:" — needs a date/time and an author
+    re.compile(
+        r"^\s*(?=.*\d{1,2}[.:/]\d{2}).{1,200}\S\s+(пишет|написал|написала|написал\(а\)):\s*$",
+        re.IGNORECASE,
+    ),
+    re.compile(r"^\s*-{2,}\s*(Original Message|Исходное сообщение)\s*-{2,}\s*$", re.IGNORECASE),
+]
+
+# Outlook-style quoted header block: a From: line followed by Sent:/To:/...
+QUOTE_FROM_PATTERN = re.compile(r"^\s*(From|От):\s.+$", re.IGNORECASE)
+QUOTE_HEADER_FIELD_PATTERN = re.compile(
+    r"^\s*(Sent|Date|To|Cc|Subject|Отправлено|Дата|Кому|Копия|Тема):\s", re.IGNORECASE
+)
+
+# Lines that start a signature block; everything after is dropped.
+# Only the RFC 3676 "-- " delimiter (trailing space required) counts, so
+# a bare "--" separator inside the message is kept. Matched before
+# normalize_whitespace, which would strip that trailing space.
+SIGNATURE_PATTERNS = [
+    re.compile(r"^[ \t]*--[ \u00a0]$"),
+    re.compile(r"^\s*(Sent from my|Отправлено с|Отправлено из)\b.*$", re.IGNORECASE),
+]
+
+# boundary= parameter of a Content-Type header, scanned before parsing
+BOUNDARY_PATTERN = re.compile(rb'boundary\s*=\s*"?([^";]+)"?', re.IGNORECASE)
+
+_charset_cache: dict = {}
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+@dataclass
+class ParsedEmail:
+    """Result of parsing a single raw email."""
+    message_id: str
+    sender: str
+    subject: str
+    body: str
+
+
+def decode_mime_header(header_value: str) -> str:
+    """Decode a MIME-encoded email header."""
+    if not header_value:
+        return ""
+    decoded_parts = decode_header(header_value)
+    result = []
+    for part, charset in decoded_parts:
+        if isinstance(part, bytes):
+            result.append(part.decode(_safe_charset(charset) or "utf-8", errors="replace"))
+        else:
+            result.append(part)
+    return " ".join(result)
+
+
+def _safe_charset(charset: Optional[str]) -> Optional[str]:
+    """Return charset if Python knows it, otherwise None."""
+    if not charset:
+        return None
+    try:
+        "".encode(charset)
+    except LookupError:
+        return None
+    return charset
+
+
+def _sender_domain(sender: str) -> str:
+    return sender.rpartition("@")[2].lower()
+
+
+def _cyrillic_score(text: str) -> float:
+    """
+    Score how much text looks like correctly decoded Russian.
+
+    Real text is mostly lowercase and dominated by a few common letters;
+    a cp1251/koi8-r mix-up swaps case and scatters letter frequencies.
+    Returns 0.0 when there are no Cyrillic letters or words mix Cyrillic
+    with Latin (what cp1251 makes of accented Latin-1 text).
+    """
+    words = re.findall(r"[^\W\d_]+", text)
+    cyrillic = latin_cyrillic_mix = 0
+    lower = common = letters = 0
+    for word in words:
+        cyr = [c for c in word if "\u0400" <= c <= "\u04ff"]
+        if not cyr:
+            continue
+        if len(cyr) != len(word):
+            latin_cyrillic_mix += 1
+            continue
+        cyrillic += 1
+        letters += len(cyr)
+        lower += sum(c.islower() for c in cyr)
+        common += sum(c.lower() in COMMON_CYRILLIC for c in cyr)
+    if not cyrillic or latin_cyrillic_mix * 10 > cyrillic:
+        return 0.0
+    return lower / letters + common / letters
+
+
+def _cache_charset(domain: str, charset: str):
+    if len(_charset_cache) >= CHARSET_CACHE_SIZE and domain not in _charset_cache:
+        _charset_cache.pop(next(iter(_charset_cache)))
+    _charset_cache[domain] = charset
+
+
+def decode_payload(payload: bytes, declared: Optional[str], domain: str = "") -> str:
+    """
+    Decode a MIME part payload.
+
+    A known declared charset is trusted and decoded leniently, as before.
+    Without one: UTF-8, unless more than MAX_UTF8_ERROR_RATE of it is
+    undecodable; then the single-byte Cyrillic codecs ranked by
+    _cyrillic_score; then latin-1. The charset that last produced a
+    plausible single-byte decode for this sender domain is tried first
+    among the single-byte codecs.
+    """
+    declared = _safe_charset(declared)
+    if declared:
+        return payload.decode(declared, errors="replace")
+
+    text = payload.decode("utf-8", errors="replace")
+    if text.count("\ufffd") <= len(text) * MAX_UTF8_ERROR_RATE:
+        return text
+
+    cached = _charset_cache.get(domain) if domain else None
+    if cached in CYRILLIC_CHARSETS:
+        text = payload.decode(cached, errors="replace")
+        if _cyrillic_score(text) >= MIN_CYRILLIC_SCORE:
+            return text
+
+    scored = []
+    for charset in CYRILLIC_CHARSETS:
+        text = payload.decode(charset, errors="replace")
+        scored.append((_cyrillic_score(text), charset, text))
+    score, charset, text = max(scored, key=lambda item: item[0])
+    if score >= MIN_CYRILLIC_SCORE:
+        if domain:
+            _cache_charset(domain, charset)
+        return text
+
+    return payload.decode("latin-1")
+
+
+class _TextExtractor(HTMLParser):
+    """Streaming HTML-to-text converter that stops once max_chars is reached."""
+
+    def __init__(self, max_chars: int):
+        super().__init__(convert_charrefs=True)
+        self.max_chars = max_chars
+        self.parts: List[str] = []
+        self.length = 0
+        self.skip_depth = 0
+
+    @property
+    def full(self) -> bool:
+        return self.length >= self.max_chars
+
+    def _append(self, text: str):
+        if self.full:
+            return
+        text = text[: self.max_chars - self.length]
+        self.parts.append(text)
+        self.length += len(text)
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "body":
+            # Recover from unclosed <title>/<style> in the head
+            self.skip_depth = 0
+        elif tag in SKIP_TAGS:
+            self.skip_depth += 1
+        elif tag in BLOCK_TAGS:
+            self._append("\n")
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in BLOCK_TAGS:
+            self._append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif tag in BLOCK_TAGS:
+            self._append("\n")
+        elif tag in CELL_TAGS:
+            self._append(" ")
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self._append(data)
+
+    def text(self) -> str:
+        return "".join(self.parts)
+
+
+def html_to_text(html: str, max_chars: int) -> str:
+    """
+    Convert HTML to plain text, feeding in chunks and stopping at max_chars.
+
+    Work is linear in the input: data: URIs are dropped, input is capped
+    at HTML_MAX_INPUT_CHARS, and conversion stops if a single unfinished
+    construct exceeds HTML_MAX_PENDING_CHARS. Oversized <style>/<script>
+    content is discarded instead, since it is never emitted anyway.
+    """
+    html = DATA_URI_PATTERN.sub("", html[: HTML_MAX_INPUT_CHARS * 2])[:HTML_MAX_INPUT_CHARS]
+    extractor = _TextExtractor(max_chars)
+    for start in range(0, len(html), HTML_CHUNK_SIZE):
+        extractor.feed(html[start:start + HTML_CHUNK_SIZE])
+        if extractor.full:
+            break
+        if len(extractor.rawdata) > HTML_MAX_PENDING_CHARS:
+            if extractor.cdata_elem:
+                # Keep the tail in case it holds the start of the closing tag
+                extractor.rawdata = extractor.rawdata[-64:]
+                continue
+            logger.warning(f"Unterminated HTML construct over {HTML_MAX_PENDING_CHARS} chars, stopping")
+            break
+    else:
+        extractor.close()
+    return extractor.text()
+
+
+def normalize_whitespace(text: str) -> str:
+    """Collapse runs of spaces and blank lines."""
+    lines = [re.sub(r"[ \t\u00a0]+", " ", line).strip() for line in text.splitlines()]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+
+def _is_quote_header_block(lines: List[str], index: int) -> bool:
+    """True if lines[index] is a From: line opening an Outlook-style header block."""
+    if not QUOTE_FROM_PATTERN.match(lines[index]):
+        return False
+    following = [line for line in lines[index + 1:index + 4] if line.strip()]
+    return any(QUOTE_HEADER_FIELD_PATTERN.match(line) for line in following[:2])
+
+
+def strip_quotes_and_signature(text: str) -> str:
+    """Drop quoted replies ('>' lines, 'On ... wrote:' blocks) and signatures."""
+    lines = text.splitlines()
+    kept = []
+    for index, line in enumerate(lines):
+        if any(p.match(line) for p in SIGNATURE_PATTERNS):
+            break
+        if any(p.match(line) for p in REPLY_HEADER_PATTERNS):
+            break
+        if _is_quote_header_block(lines, index):
+            break
+        if line.lstrip().startswith(">"):
+            continue
+        kept.append(line)
+    stripped = "\n".join(kept).strip()
+    # Never strip a message down to nothing — keep the original instead
+    return stripped or text
+
+
+def _mime_structure_problem(raw_email: bytes, max_depth: int, max_parts: int) -> Optional[str]:
+    """
+    Check multipart nesting depth and part count on raw bytes, before
+    the email package builds the tree. Returns the reason the limits
+    are exceeded, or None if the structure is within them.
+
+    Boundaries are only read from Content-Type headers of the message,
+    its parts and embedded message/rfc822 parts; a closing delimiter
+    pops back to its boundary. Unclosed boundaries count as still open,
+    so the estimate errs towards rejecting.
+    """
+    stack: List[bytes] = []
+    parts = 0
+    in_headers = True
+    header_name = b""
+    embedded_message = False
+    for line in raw_email.splitlines():
+        if in_headers:
+            if not line.strip():
+                # An embedded message's own headers follow its part headers
+                in_headers, embedded_message = embedded_message, False
+                continue
+            if line[:1] not in (b" ", b"\t"):
+                header_name = line.split(b":", 1)[0].strip().lower()
+            if header_name != b"content-type":
+                continue
+            if b"message/rfc822" in line.lower():
+                embedded_message = True
+            match = BOUNDARY_PATTERN.search(line)
+            if match:
+                stack.append(match.group(1).strip())
+                if len(stack) > max_depth:
+                    return f"MIME nesting deeper than {max_depth}"
+            continue
+        if not line.startswith(b"--"):
+            continue
+        delimiter = line[2:].rstrip()
+        if delimiter.endswith(b"--") and delimiter[:-2] in stack:
+            del stack[stack.index(delimiter[:-2]):]
+        elif delimiter in stack:
+            del stack[stack.index(delimiter) + 1:]
+            parts += 1
+            if parts > max_parts:
+                return f"MIME message has more than {max_parts} parts"
+            in_headers, header_name = True, b""
+    return None
+
+
+def _truncate_raw(raw_email: bytes, limit: int) -> bytes:
+    """Cut raw bytes to limit at the last MIME delimiter (or line) before it."""
+    cut = raw_email.rfind(b"\n--", 0, limit)
+    if cut <= 0:
+        cut = raw_email.rfind(b"\n", 0, limit)
+    return raw_email[: cut + 1 if cut > 0 else limit]
+
+
+def _find_text_parts(msg: Message, max_depth: int, max_parts: int):
+    """
+    Walk the parsed MIME tree with depth and part-count limits.
+
+    This only bounds the walk; parse cost is bounded earlier by
+    _mime_structure_problem and EMAIL_MAX_RAW_BYTES.
+
+    Returns (first text/plain part, first text/html part), skipping attachments.
+    """
+    plain = html = None
+    stack = [(msg, 0)]
+    visited = 0
+    while stack and visited < max_parts:
+        part, depth = stack.pop()
+        visited += 1
+        if part.is_multipart():
+            if depth >= max_depth:
+                logger.warning(f"MIME nesting deeper than {max_depth}, skipping subtree")
+                continue
+            children = part.get_payload()
+            if isinstance(children, list):
+                stack.extend((child, depth + 1) for child in reversed(children))
+            continue
+        if "attachment" in str(part.get("Content-Disposition", "")):
+            continue
+        content_type = part.get_content_type()
+        if content_type == "text/plain" and plain is None:
+            plain = part
+            break
+        if content_type == "text/html" and html is None:
+            html = part
+    if stack and visited >= max_parts:
+        logger.warning(f"MIME message has more than {max_parts} parts, truncated walk")
+    return plain, html
+
+
+def extract_body(msg: Message, sender: str = "") -> str:
+    """Extract normalized plain text body from an email message."""
+    max_chars = settings.EMAIL_MAX_BODY_CHARS
+    domain = _sender_domain(sender)
+
+    plain, html = _find_text_parts(msg, settings.EMAIL_MAX_MIME_DEPTH, settings.EMAIL_MAX_MIME_PARTS)
+    part = plain or html
+    if part is None:
+        return ""
+
+    payload = part.get_payload(decode=True)
+    if not payload:
+        return ""
+    text = decode_payload(payload, part.get_content_charset(), domain)
+
+    if part is html:
+        text = html_to_text(text, max_chars * 2)
+    text = strip_quotes_and_signature(text)
+    text = normalize_whitespace(text)
+    return text[:max_chars]
+
+
+def parse_raw_email(raw_email: bytes) -> ParsedEmail:
+    """Parse raw RFC822 bytes into a ParsedEmail. Safe to run in a worker process."""
+    if len(raw_email) > settings.EMAIL_MAX_RAW_BYTES:
+        logger.warning(
+            f"Raw email of {len(raw_email)} bytes exceeds "
+            f"{settings.EMAIL_MAX_RAW_BYTES}, truncating before parse"
+        )
+        raw_email = _truncate_raw(raw_email, settings.EMAIL_MAX_RAW_BYTES)
+
+    problem = _mime_structure_problem(
+        raw_email, settings.EMAIL_MAX_MIME_DEPTH, settings.EMAIL_MAX_MIME_PARTS
+    )
+    if problem:
+        # Hostile structure: keep the headers, skip building the MIME tree
+        msg = BytesHeaderParser().parsebytes(raw_email)
+    else:
+        msg = email_lib.message_from_bytes(raw_email)
+
+    _, sender_addr = parseaddr(msg.get("From", ""))
+    sender = sender_addr or decode_mime_header(msg.get("From", "unknown"))
+    message_id = msg.get("Message-ID", "")
+
+    if problem:
+        logger.warning(f"Not parsing body of {message_id or 'message'} from {sender}: {problem}")
+        body = f"[Body not parsed: {problem}]"
+    else:
+        body = extract_body(msg, sender)
+
+    return ParsedEmail(
+        message_id=message_id,
+        sender=sender,
+        subject=decode_mime_header(msg.get("Subject", "(no subject)")),
+        body=body,
+    )
+
+
+def _parse_or_none(raw_email: bytes) -> Optional[ParsedEmail]:
+    try:
+        return parse_raw_email(raw_email)
+    except Exception as e:
+        logger.error(f"Failed to parse email: {e}")
+        return None
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # Spawn rather than fork: the host process runs uvicorn and APScheduler threads
+        _pool = ProcessPoolExecutor(
+            max_workers=settings.EMAIL_PARSE_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _pool
+
+
+def _parse_in_pool(raw_email: bytes) -> Optional[ParsedEmail]:
+    """Parse one message in a fresh pool; None if it kills the worker."""
+    try:
+        return _get_pool().submit(_parse_or_none, raw_email).result()
+    except BrokenProcessPool:
+        shutdown_pool()
+        return None
+
+
+def parse_many(raw_emails: Iterable[bytes]) -> List[Optional[ParsedEmail]]:
+    """
+    Parse a batch of raw emails, preserving order.
+    Messages that fail to parse come back as None.
+
+    Uses a process pool when EMAIL_PARSE_WORKERS > 1 and the batch is
+    at least EMAIL_PARSE_POOL_MIN_BATCH messages; otherwise parses inline.
+    If a worker dies (e.g. OOM on a hostile message), finished results are
+    kept and the unfinished messages are retried one at a time in a fresh
+    pool, never inline, so the culprit alone comes back as None.
+    """
+    raw_emails = list(raw_emails)
+    if settings.EMAIL_PARSE_WORKERS <= 1 or len(raw_emails) < settings.EMAIL_PARSE_POOL_MIN_BATCH:
+        return [_parse_or_none(raw) for raw in raw_emails]
+
+    pool = _get_pool()
+    futures = {pool.submit(_parse_or_none, raw): index for index, raw in enumerate(raw_emails)}
+    results: List[Optional[ParsedEmail]] = [None] * len(raw_emails)
+    failed = []
+    for future in as_completed(futures):
+        index = futures[future]
+        try:
+            results[index] = future.result()
+        except BrokenProcessPool:
+            failed.append(index)
+
+    if failed:
+        logger.error(f"Parser process pool broke, retrying {len(failed)} messages one at a time")
+        shutdown_pool()
+        for index in sorted(failed):
+            results[index] = _parse_in_pool(raw_emails[index])
+    return results
+
+
+def shutdown_pool():
+    """Stop the parser process pool, if one was started."""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
@@ -0,0 +1,259 @@
+import os
+import signal
+import time
+from email.mime.message import MIMEMessage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+import pytest
+
+from app.services import email_parser
+from app.services.email_parser import (
+    _find_text_parts,
+    _mime_structure_problem,
+    decode_payload,
+    html_to_text,
+    normalize_whitespace,
+    parse_raw_email,
+    strip_quotes_and_signature,
+)
+
+RUSSIAN = "Привет, у нас не работает оплата на сайте, помогите пожалуйста"
+
+
+@pytest.fixture(autouse=True)
+def clear_charset_cache():
+    email_parser._charset_cache.clear()
+    yield
+    email_parser._charset_cache.clear()
+
+
+def _parse_or_kill_worker(raw_email: bytes):
+    # Stands in for a message that gets the pool worker OOM-killed
+    if b"kill@me" in raw_email:
+        os.kill(os.getpid(), signal.SIGKILL)
+    return email_parser.parse_raw_email(raw_email)
+
+
+def _nested(depth: int) -> MIMEMultipart:
+    msg = MIMEText("deep body")
+    for _ in range(depth):
+        outer = MIMEMultipart()
+        outer.attach(msg)
+        msg = outer
+    return msg
+
+
+# --- decode_payload ---
+
+def test_decode_declared_charset():
+    assert decode_payload(RUSSIAN.encode("koi8-r"), "koi8-r") == RUSSIAN
+
+
+def test_decode_undeclared_cp1251_and_koi8r():
+    assert decode_payload(RUSSIAN.encode("cp1251"), None, "a.ru") == RUSSIAN
+    assert decode_payload(RUSSIAN.encode("koi8-r"), None, "b.ru") == RUSSIAN
+    assert email_parser._charset_cache == {"a.ru": "cp1251", "b.ru": "koi8-r"}
+
+
+def test_cached_charset_does_not_override_utf8():
+    decode_payload(RUSSIAN.encode("cp1251"), None, "x.ru")
+    assert decode_payload("Привет мир".encode("utf-8"), None, "x.ru") == "Привет мир"
+
+
+def test_cached_charset_does_not_override_better_single_byte_match():
+    decode_payload(RUSSIAN.encode("cp1251"), None, "x.ru")
+    assert decode_payload(RUSSIAN.encode("koi8-r"), None, "x.ru") == RUSSIAN
+
+
+def test_latin1_fallback_is_not_cached():
+    text = "café au lait, très bien"
+    assert decode_payload(text.encode("latin-1"), None, "f.fr") == text
+    assert "f.fr" not in email_parser._charset_cache
+
+
+def test_declared_utf8_with_stray_byte_is_not_redecoded():
+    text = "Здравствуйте, у нас не работает оплата. It’s urgent."
+    decoded = decode_payload(text.encode() + b"\xff", "utf-8", "corp.ru")
+    assert decoded == text + "\ufffd"
+    assert "corp.ru" not in email_parser._charset_cache
+
+
+def test_undeclared_utf8_with_stray_byte_stays_utf8():
+    text = "Здравствуйте, у нас не работает оплата на сайте"
+    assert decode_payload(text.encode() + b"\xff", None, "corp.ru") == text + "\ufffd"
+
+
+def test_unknown_declared_charset_falls_back():
+    assert decode_payload("hello".encode(), "x-unknown-charset") == "hello"
+
+
+# --- html_to_text ---
+
+def test_html_skips_style_script_and_images():
+    html = (
+        "<html><head><style>p{color:red}</style><script>var x;</script></head>"
+        '<body><p>Hello&nbsp;there</p><img src="data:image/png;base64,AAAA"></body></html>'
+    )
+    assert normalize_whitespace(html_to_text(html, 1000)) == "Hello there"
+
+
+def test_html_unclosed_head_keeps_body():
+    html = "<html><head><title>x</title><body><p>Hello there</p>"
+    assert normalize_whitespace(html_to_text(html, 1000)) == "Hello there"
+
+
+def test_html_table_cells_are_separated():
+    html = "<table><tr><td>Name</td><td>Value</td></tr></table>"
+    assert normalize_whitespace(html_to_text(html, 1000)) == "Name Value"
+
+
+def test_html_respects_size_cap():
+    html = "<p>" + "word " * 10000 + "</p>"
+    assert len(html_to_text(html, 100)) == 100
+
+
+def test_html_unclosed_tag_is_linear():
+    # Used to be quadratic: ~40s of CPU for 10 MB
+    html = "<p>hi</p><div " + "a" * 10_000_000
+    started = time.monotonic()
+    assert normalize_whitespace(html_to_text(html, 20000)) == "hi"
+    assert time.monotonic() - started < 2
+
+
+def test_html_large_style_and_inline_image_keep_following_text():
+    html = (
+        "<style>" + "a{}" * 300_000 + "</style><p>after style</p>"
+        '<img src="data:image/png;base64,' + "A" * 3_000_000 + '"><p>after img</p>'
+    )
+    assert normalize_whitespace(html_to_text(html, 20000)) == "after style\n\nafter img"
+
+
+# --- strip_quotes_and_signature ---
+
+def test_strips_quoted_reply():
+    text = "Ok, thanks\nOn Mon, 1 Jan 2024, Bob wrote:\n> old message"
+    assert strip_quotes_and_signature(text) == "Ok, thanks"
+
+
+def test_strips_russian_reply_header_with_date():
+    text = "Спасибо\n15.03.2024, 10:20, Иван <ivan@x.ru> пишет:\n> старое"
+    assert strip_quotes_and_signature(text) == "Спасибо"
+
+
+def test_keeps_russian_pishet_without_date():
+    text = "Hello\nКлиент пишет:\nне работает оплата"
+    assert strip_quotes_and_signature(text) == text
+
+
+def test_strips_outlook_header_block():
+    text = "Thanks\nFrom: Bob <b@x.com>\nSent: Monday\nTo: me\nold stuff"
+    assert strip_quotes_and_signature(text) == "Thanks"
+
+
+def test_keeps_lone_from_line():
+    text = "Hi, please see forwarded below\nFrom: boss@corp.com\nThe server is down, error 500"
+    assert strip_quotes_and_signature(text) == text
+
+
+def test_strips_signature():
+    assert strip_quotes_and_signature("Help me\n-- \nIvan\nCEO") == "Help me"
+
+
+def test_keeps_text_after_bare_separator():
+    text = "Order list:\n--\nitem 1 broken\nitem 2 broken"
+    assert strip_quotes_and_signature(text) == text
+
+
+def test_parse_raw_email_strips_html_signature():
+    msg = MIMEText("<p>Help me</p><p>-- </p><p>Ivan</p>", "html")
+    assert parse_raw_email(msg.as_bytes()).body == "Help me"
+
+
+def test_never_strips_to_empty():
+    assert strip_quotes_and_signature("> only quoted") == "> only quoted"
+
+
+# --- MIME limits ---
+
+def test_find_text_parts_depth_limit():
+    msg = _nested(5)
+    assert _find_text_parts(msg, max_depth=10, max_parts=100)[0] is not None
+    assert _find_text_parts(msg, max_depth=3, max_parts=100) == (None, None)
+
+
+def test_find_text_parts_part_limit():
+    msg = MIMEMultipart()
+    for _ in range(10):
+        msg.attach(MIMEText("<p>x</p>", "html"))
+    msg.attach(MIMEText("plain"))
+    assert _find_text_parts(msg, max_depth=10, max_parts=5) == (None, msg.get_payload()[0])
+
+
+def test_mime_structure_problem_limits():
+    assert _mime_structure_problem(_nested(3).as_bytes(), max_depth=3, max_parts=100) is None
+    assert _mime_structure_problem(_nested(4).as_bytes(), max_depth=3, max_parts=100) == (
+        "MIME nesting deeper than 3"
+    )
+
+    wide = MIMEMultipart()
+    for _ in range(20):
+        wide.attach(MIMEText("x"))
+    assert _mime_structure_problem(wide.as_bytes(), max_depth=10, max_parts=20) is None
+    assert _mime_structure_problem(wide.as_bytes(), max_depth=10, max_parts=19) == (
+        "MIME message has more than 19 parts"
+    )
+
+
+def test_mime_structure_ignores_boundary_text_in_body():
+    body = "\n".join(f"boundary=foo{i}" for i in range(50))
+    msg = MIMEMultipart()
+    msg.attach(MIMEText(body))
+    assert _mime_structure_problem(MIMEText(body).as_bytes(), max_depth=3, max_parts=100) is None
+    assert _mime_structure_problem(msg.as_bytes(), max_depth=3, max_parts=100) is None
+
+
+def test_mime_structure_counts_embedded_messages():
+    inner = _nested(3)
+    outer = MIMEMultipart()
+    outer.attach(MIMEMessage(inner))
+    assert _mime_structure_problem(outer.as_bytes(), max_depth=4, max_parts=100) is None
+    assert _mime_structure_problem(outer.as_bytes(), max_depth=3, max_parts=100) is not None
+
+
+def test_parse_raw_email_hostile_nesting_keeps_headers():
+    msg = _nested(50)
+    msg["From"] = "Ivan <ivan@mail.ru>"
+    msg["Subject"] = "help"
+    parsed = parse_raw_email(msg.as_bytes())
+    assert (parsed.sender, parsed.subject) == ("ivan@mail.ru", "help")
+    assert parsed.body == "[Body not parsed: MIME nesting deeper than 10]"
+
+
+def test_parse_raw_email_html_only():
+    msg = MIMEMultipart("alternative")
+    msg["From"] = "a@b.com"
+    msg["Subject"] = "=?utf-8?b?0J/RgNC40LLQtdGC?="
+    msg["Message-ID"] = "<1@b.com>"
+    msg.attach(MIMEText("<html><body><p>Hello</p><div>world</div></body></html>", "html"))
+    parsed = parse_raw_email(msg.as_bytes())
+    assert parsed.subject == "Привет"
+    assert parsed.message_id == "<1@b.com>"
+    assert parsed.body == "Hello\n\nworld"
+
+
+# --- parse_many ---
+
+def test_parse_many_isolates_worker_crash(monkeypatch):
+    monkeypatch.setattr(email_parser.settings, "EMAIL_PARSE_WORKERS", 2)
+    monkeypatch.setattr(email_parser.settings, "EMAIL_PARSE_POOL_MIN_BATCH", 2)
+    monkeypatch.setattr(email_parser, "_parse_or_none", _parse_or_kill_worker)
+    batch = [f"From: user{i}@b.com\r\n\r\nhello".encode() for i in range(4)]
+    batch.insert(2, b"From: kill@me\r\n\r\nboom")
+    try:
+        results = email_parser.parse_many(batch)
+    finally:
+        email_parser.shutdown_pool()
+    assert [r and r.sender for r in results] == [
+        "user0@b.com", "user1@b.com", None, "user2@b.com", "user3@b.com",
+    ]